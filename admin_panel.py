@@ -1,15 +1,30 @@
 import time
 import re
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
+from cachetools import TTLCache
 from telebot import types
+from telebot.custom_filters import SimpleCustomFilter
+from telebot.apihelper import ApiTelegramException
 
 # ✅ GLOBAL: bot.py fallback যেন admin-step নষ্ট না করে
-ADMIN_STEPS = {}
+# admin মাঝপথে ছেড়ে দিলে step 10 মিনিট পরে নিজে থেকেই মুছে যাবে
+ADMIN_STEPS = TTLCache(maxsize=1024, ttl=600)
 
 def is_waiting(uid: int) -> bool:
     return uid in ADMIN_STEPS
 
 
+class AdminStepFilter(SimpleCustomFilter):
+    # handler এ admin_step=True / admin_step=False দিয়ে step handler আর fallback আলাদা হয়
+    key = "admin_step"
+
+    def check(self, message):
+        return bool(message.from_user) and is_waiting(message.from_user.id)
+
+
 def fmt_date(ts):
     if ts is None:
         return "N/A"
@@ -23,6 +38,81 @@ def parse_int(text: str) -> int:
     return int(nums[0])
 
 
+# ---------- Broadcast ----------
+BCAST_WORKERS = 25
+BCAST_RATE = 29  # Telegram global limit ~30 msg/sec
+BCAST_TRIES = 4   # network/5xx error এ exponential backoff সহ এতবার চেষ্টা
+
+
+def _is_dead(e: ApiTelegramException) -> bool:
+    # 403 = block/deactivated; 400 শুধু chat না থাকলে (অন্য 400 মানে message টাই খারাপ)
+    if e.error_code == 403:
+        return True
+    return e.error_code == 400 and "chat not found" in (e.description or "").lower()
+
+
+class RateLimiter:
+    # thread-safe pacing: সব thread মিলিয়ে প্রতি সেকেন্ডে সর্বোচ্চ `rate` টা call
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self.next_at = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            at = max(now, self.next_at)
+            self.next_at = at + self.interval
+        if at > now:
+            time.sleep(at - now)
+
+    def pause(self, seconds: float):
+        # 429 এ সব worker কেই থামাতে হবে, শুধু যে thread টা 429 পেয়েছে সেটা না
+        with self.lock:
+            self.next_at = max(self.next_at, time.monotonic() + seconds)
+
+
+def broadcast(bot, id_batches, text: str):
+    limiter = RateLimiter(BCAST_RATE)
+
+    def send_one(uid: int) -> str:
+        attempt = 0
+        while attempt < BCAST_TRIES:
+            limiter.wait()
+            try:
+                bot.send_message(uid, text)
+                return "sent"
+            except ApiTelegramException as e:
+                if e.error_code == 429:
+                    # Telegram নিজেই বলে দেয় কতক্ষণ থামতে হবে; throttle এ try কমে না
+                    params = (e.result_json or {}).get("parameters") or {}
+                    limiter.pause(params.get("retry_after", 1))
+                    continue
+                if _is_dead(e):
+                    return "dead"
+                if e.error_code == 400:
+                    return "failed"
+            except Exception:
+                pass
+            time.sleep(0.5 * 2 ** attempt + random.uniform(0, 0.5))
+            attempt += 1
+        return "failed"
+
+    sent = 0
+    failed = 0
+    dead = []
+    with ThreadPoolExecutor(max_workers=BCAST_WORKERS, thread_name_prefix="bcast") as ex:
+        for batch in id_batches:
+            for uid, res in zip(batch, ex.map(send_one, batch)):
+                if res == "sent":
+                    sent += 1
+                else:
+                    failed += 1
+                    if res == "dead":
+                        dead.append(uid)
+    return sent, failed, dead
+
+
 # ---------- Keyboards ----------
 def admin_menu_kb():
     kb = types.InlineKeyboardMarkup()
@@ -37,15 +127,19 @@ def users_page_kb(users, offset, total):
     kb = types.InlineKeyboardMarkup()
 
     for u in users:
-        uname = u.get("username") or "unknown"
-        label = f"👤 {u['id']} @{uname} | 💳 {u.get('credits',0)}"
+        uname = u["username"] or "unknown"
+        label = f"👤 {u['id']} @{uname} | 💳 {u['credits']}"
         kb.add(types.InlineKeyboardButton(label[:64], callback_data=f"adm:user:{u['id']}:{offset}"))
 
     nav = []
     if offset > 0:
         nav.append(types.InlineKeyboardButton("⬅ Prev", callback_data=f"adm:users:{max(0, offset-10)}"))
-    if offset + 10 < total:
-        nav.append(types.InlineKeyboardButton("Next ➡", callback_data=f"adm:users:{offset+10}"))
+    if offset + 10 < total and users:
+        # শেষ row এর (joined_at, id) cursor হিসেবে যায়, পরের page OFFSET ছাড়াই
+        last = users[-1]
+        nav.append(types.InlineKeyboardButton(
+            "Next ➡", callback_data=f"adm:users:{offset+10}:{last['joined_at'] or 0}:{last['id']}"
+        ))
     if nav:
         kb.row(*nav)
 
@@ -98,6 +192,7 @@ def send_admin_panel(bot, db, chat_id: int):
 # ---------- Register ----------
 def register_admin_panel(bot, db, config):
     steps = ADMIN_STEPS
+    bot.add_custom_filter(AdminStepFilter())
 
     def is_admin(uid: int) -> bool:
         return uid in config.ADMIN_IDS
@@ -125,8 +220,9 @@ def register_admin_panel(bot, db, config):
 
         if act == "users":
             offset = int(parts[2]) if len(parts) >= 3 and parts[2].isdigit() else 0
+            after = (int(parts[3]), int(parts[4])) if len(parts) >= 5 else None
             total = db.count_users()
-            users = db.list_users(offset=offset, limit=10)
+            users = db.list_users(offset=offset, limit=10, after=after)
             return bot.send_message(
                 call.message.chat.id,
                 f"👥 Users (showing {offset+1}-{min(offset+10,total)} of {total})",
@@ -219,13 +315,14 @@ def register_admin_panel(bot, db, config):
 
         if act == "download":
             try:
+                db.checkpoint()
                 with open(config.DB_PATH, "rb") as f:
                     return bot.send_document(call.message.chat.id, f)
             except Exception:
                 return bot.send_message(call.message.chat.id, "DB not found!")
 
     # ✅ ADMIN STEP HANDLER (broadcast/custom credit/custom validity)
-    @bot.message_handler(func=lambda m: m.from_user and m.from_user.id in steps, content_types=["text"])
+    @bot.message_handler(admin_step=True, content_types=["text"])
     def step_handler(message):
         uid = message.from_user.id
         if not is_admin(uid):
@@ -282,21 +379,15 @@ def register_admin_panel(bot, db, config):
             # ✅ BROADCAST SEND
             elif step["type"] == "bcast":
                 text = message.text or ""
-                user_ids = db.list_user_ids()
-                bot.send_message(message.chat.id, f"📣 Broadcasting to {len(user_ids)} users...")
-
-                sent = 0
-                failed = 0
-                for uid2 in user_ids:
-                    try:
-                        bot.send_message(uid2, text)
-                        sent += 1
-                        time.sleep(0.05)
-                    except Exception:
-                        failed += 1
-                        time.sleep(0.2)
-
-                bot.send_message(message.chat.id, f"✅ Done.\nSent: {sent}\nFailed: {failed}")
+                bot.send_message(message.chat.id, f"📣 Broadcasting to {db.count_recipients()} users...")
+
+                sent, failed, dead = broadcast(bot, db.iter_user_ids(), text)
+                # পরের broadcast এ এদের আর পাঠানো হবে না
+                db.mark_dead(dead)
+                bot.send_message(
+                    message.chat.id,
+                    f"✅ Done.\nSent: {sent}\nFailed: {failed}\nBlocked/removed: {len(dead)}"
+                )
 
         except Exception as e:
             bot.send_message(message.chat.id, f"❌ Error: {e}")
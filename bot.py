@@ -1,18 +1,24 @@
 import os
+import json
+import functools
 import tempfile
 import subprocess
 import shutil
+import threading
 from pathlib import Path
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 
 import telebot
 from telebot import types
 
 import imageio_ffmpeg
+from cachetools import TTLCache
 
 import config
 from db import DB
-from admin_panel import register_admin_panel, send_admin_panel, is_waiting
+from admin_panel import register_admin_panel, send_admin_panel
 
 
 # =========================
@@ -23,7 +29,15 @@ db = DB(config.DB_PATH)
 if not config.BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN missing! Railway Variables এ BOT_TOKEN দিন।")
 
-bot = telebot.TeleBot(config.BOT_TOKEN, parse_mode="HTML")
+bot = telebot.TeleBot(config.BOT_TOKEN, parse_mode="HTML", num_threads=config.BOT_THREADS)
+
+# cosmetic API calls (chat action ইত্যাদি) handler কে আটকাবে না
+BG = ThreadPoolExecutor(max_workers=4, thread_name_prefix="bg")
+
+
+def fire_and_forget(fn, *args, **kwargs):
+    # result/exception কেউ দেখবে না; future এর মধ্যেই থেকে যায়
+    BG.submit(fn, *args, **kwargs)
 
 
 # =========================
@@ -36,6 +50,8 @@ BTN_CHANNEL = "📣 CHANNEL"
 BTN_USAGE = "📊 USAGE"
 BTN_ADMIN_PANEL = "⚙️ ADMIN PANEL"  # শুধু admin দেখবে
 
+MENU_BUTTONS = frozenset({BTN_MODEL, BTN_VOICE, BTN_CONTACT, BTN_CHANNEL, BTN_USAGE, BTN_ADMIN_PANEL})
+
 
 def is_admin(uid: int) -> bool:
     return uid in config.ADMIN_IDS
@@ -60,18 +76,33 @@ def url_btn(title: str, url: str):
     return mk
 
 
-def menu_kb(uid: int):
+def build_menu_kb(admin: bool):
     kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
     kb.row(BTN_MODEL, BTN_VOICE)
     kb.row(BTN_CONTACT, BTN_CHANNEL)
     kb.row(BTN_USAGE)
 
     # ✅ only admin sees this
-    if is_admin(uid):
+    if admin:
         kb.row(BTN_ADMIN_PANEL)
     return kb
 
 
+# ✅ links/menu config runtime এ বদলায় না, তাই keyboard গুলো একবারই বানাই
+USER_MENU_KB = build_menu_kb(admin=False)
+ADMIN_MENU_KB = build_menu_kb(admin=True)
+
+MODEL_KB = url_btn("Open Model Support", config.MODEL_SUPPORT_LINK)
+VOICE_KB = url_btn("Open Voice Support", config.VOICE_SUPPORT_LINK)
+CONTACT_KB = url_btn("Contact Admin", config.ADMIN_CONTACTS)
+CHANNEL_KB = url_btn("Open Channel", config.REQUIRED_CHANNEL)
+JOIN_KB = url_btn("📣 Join Channel", config.REQUIRED_CHANNEL)
+
+
+def menu_kb(uid: int):
+    return ADMIN_MENU_KB if is_admin(uid) else USER_MENU_KB
+
+
 def fmt_date(ts):
     if ts is None:
         return "N/A"
@@ -95,7 +126,11 @@ def is_subscribed(user_id: int) -> bool:
 TARGET_SIZE = 640
 MAX_SECONDS = 60
 
+# একসাথে কয়টা ffmpeg চলবে (বাকিরা queue তে অপেক্ষা করবে)
+FFMPEG_SEM = threading.BoundedSemaphore(config.FFMPEG_JOBS)
 
+
+@functools.lru_cache(maxsize=1)
 def ffmpeg_path() -> str:
     p = os.getenv("FFMPEG_PATH")
     if p:
@@ -106,23 +141,178 @@ def ffmpeg_path() -> str:
     return imageio_ffmpeg.get_ffmpeg_exe()
 
 
+# hardware H.264 encoders in preference order; libx264 (CPU) is the fallback
+HW_ENCODERS = ("h264_nvenc", "h264_vaapi", "h264_qsv", "h264_videotoolbox")
+VAAPI_DEVICE = os.getenv("VAAPI_DEVICE", "/dev/dri/renderD128")
+
+
+def encoder_args(encoder: str):
+    """-> (args before -i, pixel format filter, codec args)"""
+    if encoder == "h264_nvenc":
+        return [], "format=yuv420p", ["-c:v", "h264_nvenc", "-preset", "p1", "-rc", "cbr", "-b:v", "800k"]
+    if encoder == "h264_vaapi":
+        return ["-vaapi_device", VAAPI_DEVICE], "format=nv12,hwupload", ["-c:v", "h264_vaapi", "-b:v", "800k"]
+    if encoder == "h264_qsv":
+        return [], "format=nv12", ["-c:v", "h264_qsv", "-preset", "veryfast", "-b:v", "800k"]
+    if encoder == "h264_videotoolbox":
+        return [], "format=yuv420p", ["-c:v", "h264_videotoolbox", "-b:v", "800k"]
+    return [], "format=yuv420p", ["-c:v", "libx264", "-preset", "veryfast", "-tune", "zerolatency", "-crf", "23"]
+
+
+def encoder_works(encoder: str) -> bool:
+    # listed in `ffmpeg -encoders` না হলেও build এ থাকতে পারে, তাই 1 frame encode করে দেখি
+    pre, pix, codec = encoder_args(encoder)
+    cmd = [
+        ffmpeg_path(), "-hide_banner", "-v", "error",
+        *pre,
+        "-f", "lavfi", "-i", f"color=c=black:s={TARGET_SIZE}x{TARGET_SIZE}:d=0.1",
+        "-vf", pix,
+        *codec,
+        "-frames:v", "1", "-f", "null", "-",
+    ]
+    try:
+        return subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=20).returncode == 0
+    except (OSError, subprocess.SubprocessError):
+        return False
+
+
+@functools.lru_cache(maxsize=1)
+def choose_encoder() -> str:
+    if not config.USE_HWENC:
+        return "libx264"
+    try:
+        listed = subprocess.run(
+            [ffmpeg_path(), "-hide_banner", "-encoders"],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, timeout=20,
+        ).stdout
+    except (OSError, subprocess.SubprocessError):
+        return "libx264"
+
+    for enc in HW_ENCODERS:
+        if f" {enc} " in listed and encoder_works(enc):
+            return enc
+    return "libx264"
+
+
+# একসাথে চলা job গুলো /dev/shm এ কতটা জায়গা নিয়ে রেখেছে (এখনও লেখা না হলেও)
+SHM_LOCK = threading.Lock()
+SHM_RESERVED = 0
+
+
+@contextmanager
+def scratch_dir(size_hint: int):
+    # in.mp4 + out.mp4 RAM (/dev/shm) এ রাখি যদি জায়গা থাকে, নাহলে normal temp dir (disk)
+    # free space check + reserve একই lock এ, নাহলে একসাথে শুরু হওয়া job গুলো সবাই একই free space দেখে
+    global SHM_RESERVED
+    need = 3 * (size_hint or 20 * 1024 * 1024)
+    path = None
+    if config.SHM_DIR:
+        with SHM_LOCK:
+            try:
+                if shutil.disk_usage(config.SHM_DIR).free - SHM_RESERVED > need:
+                    SHM_RESERVED += need
+                    path = config.SHM_DIR
+            except OSError:
+                pass
+    try:
+        yield path
+    finally:
+        if path:
+            with SHM_LOCK:
+                SHM_RESERVED -= need
+
+
+@contextmanager
+def ffmpeg_slot(chat_id: int):
+    if not FFMPEG_SEM.acquire(blocking=False):
+        bot.send_message(chat_id, "⏳ অনেকগুলো ভিডিও process হচ্ছে, আপনার ভিডিও queue তে আছে...")
+        FFMPEG_SEM.acquire()
+    try:
+        yield
+    finally:
+        FFMPEG_SEM.release()
+
+
 def build_ffmpeg_cmd(inp: str, outp: str) -> list[str]:
+    pre, pix, codec = encoder_args(choose_encoder())
     vf = (
         f"scale={TARGET_SIZE}:{TARGET_SIZE}:force_original_aspect_ratio=increase,"
-        f"crop={TARGET_SIZE}:{TARGET_SIZE},format=yuv420p"
+        f"crop={TARGET_SIZE}:{TARGET_SIZE},{pix}"
     )
     return [
         ffmpeg_path(), "-y",
+        *pre,
         "-i", inp,
         "-t", str(MAX_SECONDS),
         "-vf", vf,
-        "-c:v", "libx264", "-preset", "veryfast", "-crf", "23",
+        *codec,
+        "-threads", str(config.FFMPEG_THREADS),
         "-c:a", "aac", "-b:a", "96k",
         "-movflags", "+faststart",
         outp
     ]
 
 
+def ffprobe_path():
+    return os.getenv("FFPROBE_PATH") or shutil.which("ffprobe")
+
+
+def probe(inp: str) -> dict:
+    fp = ffprobe_path()
+    if not fp:
+        return {}
+    cmd = [
+        fp, "-v", "error",
+        "-select_streams", "v:0",
+        "-show_entries", "stream=codec_name,width,height,pix_fmt,duration",
+        "-of", "json",
+        inp,
+    ]
+    try:
+        r = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=30)
+        streams = json.loads(r.stdout).get("streams") or []
+    except (OSError, subprocess.SubprocessError, ValueError):
+        return {}
+    return streams[0] if streams else {}
+
+
+def is_note_ready(info: dict) -> bool:
+    # আগে থেকেই 640x640 H.264 ≤60s হলে re-encode লাগবে না
+    try:
+        duration = float(info.get("duration"))
+    except (TypeError, ValueError):
+        return False
+    return (
+        info.get("codec_name") == "h264"
+        and info.get("pix_fmt") == "yuv420p"
+        and info.get("width") == TARGET_SIZE
+        and info.get("height") == TARGET_SIZE
+        and duration <= MAX_SECONDS
+    )
+
+
+def build_remux_cmd(inp: str, outp: str) -> list[str]:
+    return [
+        ffmpeg_path(), "-y",
+        "-i", inp,
+        "-map", "0:v:0", "-map", "0:a:0?",
+        "-c", "copy",
+        "-movflags", "+faststart",
+        outp
+    ]
+
+
+def convert_video(inp: str, outp: str):
+    if is_note_ready(probe(inp)):
+        try:
+            subprocess.run(build_remux_cmd(inp, outp), check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            return
+        except subprocess.CalledProcessError:
+            pass  # audio codec mp4 এ copy না হলে full encode
+
+    subprocess.run(build_ffmpeg_cmd(inp, outp), check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
 # =========================
 # START / FREE / USAGE
 # =========================
@@ -156,11 +346,18 @@ def free_cmd(message):
         return bot.send_message(
             message.chat.id,
             f"🎁 Free credits পেতে আগে join করুন: {config.REQUIRED_CHANNEL}\nJoin করে আবার /free দিন।",
-            reply_markup=url_btn("📣 Join Channel", config.REQUIRED_CHANNEL),
+            reply_markup=JOIN_KB,
         )
 
-    db.add_credits(uid, config.FREE_CREDITS)
-    db.mark_free_claimed(uid)
+    # check + add + mark এক transaction এ: একসাথে দুইটা /free এলেও credit একবারই যোগ হবে
+    # (transaction এর ভেতরে network call করি না, writer আটকে থাকে)
+    with db.transaction():
+        claimed = db.free_claimed(uid)
+        if not claimed:
+            db.add_credits(uid, config.FREE_CREDITS)
+            db.mark_free_claimed(uid)
+    if claimed:
+        return bot.reply_to(message, "✅ আপনি আগেই free credits নিয়েছেন।", reply_markup=menu_kb(uid))
     bot.send_message(message.chat.id, f"🎁 Added {config.FREE_CREDITS} free credits ✅", reply_markup=menu_kb(uid))
 
 
@@ -184,9 +381,7 @@ def usage_cmd(message):
 # =========================
 # MENU HANDLER
 # =========================
-@bot.message_handler(func=lambda m: (m.text or "").strip() in {
-    BTN_MODEL, BTN_VOICE, BTN_CONTACT, BTN_CHANNEL, BTN_USAGE, BTN_ADMIN_PANEL
-}, content_types=["text"])
+@bot.message_handler(func=lambda m: (m.text or "").strip() in MENU_BUTTONS, content_types=["text"])
 def menu_handler(message):
     db.upsert_user(message.from_user)
     uid = message.from_user.id
@@ -196,28 +391,28 @@ def menu_handler(message):
         return bot.send_message(
             message.chat.id,
             "🧠 <b>MODEL SUPPORT</b>",
-            reply_markup=url_btn("Open Model Support", config.MODEL_SUPPORT_LINK),
+            reply_markup=MODEL_KB,
         )
 
     if t == BTN_VOICE:
         return bot.send_message(
             message.chat.id,
             "🎙 <b>VOICE SUPPORT</b>",
-            reply_markup=url_btn("Open Voice Support", config.VOICE_SUPPORT_LINK),
+            reply_markup=VOICE_KB,
         )
 
     if t == BTN_CONTACT:
         return bot.send_message(
             message.chat.id,
             "🧑‍💼 <b>ADMIN CONTACT</b>",
-            reply_markup=url_btn("Contact Admin", config.ADMIN_CONTACTS),
+            reply_markup=CONTACT_KB,
         )
 
     if t == BTN_CHANNEL:
         return bot.send_message(
             message.chat.id,
             "📣 <b>CHANNEL</b>",
-            reply_markup=url_btn("Open Channel", config.REQUIRED_CHANNEL),
+            reply_markup=CHANNEL_KB,
         )
 
     if t == BTN_USAGE:
@@ -232,20 +427,25 @@ def menu_handler(message):
 # =========================
 # VIDEO HANDLER (credits required)
 # =========================
-@bot.message_handler(content_types=["video", "document"])
+# input file_unique_id -> file_id of the video note we already made from it
+# (same clip আবার এলে download/ffmpeg ছাড়াই পাঠিয়ে দিই)
+NOTE_CACHE = TTLCache(maxsize=1024, ttl=600)
+NOTE_CACHE_LOCK = threading.Lock()
+
+
+@bot.message_handler(content_types=["video"])
 def handle_video(message):
-    db.upsert_user(message.from_user)
-    uid = message.from_user.id
+    process_video(message, message.video)
 
-    file_id = None
-    if message.content_type == "video" and message.video:
-        file_id = message.video.file_id
-    elif message.content_type == "document" and message.document:
-        if (message.document.mime_type or "").startswith("video/"):
-            file_id = message.document.file_id
 
-    if not file_id:
-        return
+@bot.message_handler(content_types=["document"], func=lambda m: (m.document.mime_type or "").startswith("video/"))
+def handle_video_document(message):
+    process_video(message, message.document)
+
+
+def process_video(message, media):
+    db.upsert_user(message.from_user)
+    uid = message.from_user.id
 
     ok = db.deduct_for_video(uid, config.CREDITS_PER_VIDEO)
     if not ok:
@@ -258,47 +458,62 @@ def handle_video(message):
         )
         return
 
-    bot.send_chat_action(message.chat.id, "upload_video_note")
+    fire_and_forget(bot.send_chat_action, message.chat.id, "upload_video_note")
 
     try:
-        with tempfile.TemporaryDirectory() as td:
-            td = Path(td)
-            inp = str(td / "in.mp4")
-            outp = str(td / "out.mp4")
+        with NOTE_CACHE_LOCK:
+            note_id = NOTE_CACHE.get(media.file_unique_id)
+
+        if note_id:
+            bot.send_video_note(message.chat.id, note_id, length=TARGET_SIZE)
+        else:
+            with ffmpeg_slot(message.chat.id), scratch_dir(media.file_size) as sd, \
+                    tempfile.TemporaryDirectory(dir=sd) as td:
+                td = Path(td)
+                inp = str(td / "in.mp4")
+                outp = str(td / "out.mp4")
 
-            f = bot.get_file(file_id)
-            data = bot.download_file(f.file_path)
-            with open(inp, "wb") as w:
-                w.write(data)
+                f = bot.get_file(media.file_id)
+                data = bot.download_file(f.file_path)
+                with open(inp, "wb") as w:
+                    w.write(data)
 
-            cmd = build_ffmpeg_cmd(inp, outp)
-            subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                convert_video(inp, outp)
 
-            with open(outp, "rb") as r:
-                bot.send_video_note(message.chat.id, r, length=TARGET_SIZE)
+                with open(outp, "rb") as r:
+                    sent = bot.send_video_note(message.chat.id, r, length=TARGET_SIZE)
+
+            if sent.video_note:
+                with NOTE_CACHE_LOCK:
+                    NOTE_CACHE[media.file_unique_id] = sent.video_note.file_id
 
         db.inc_videos(uid)
 
     except Exception as e:
+        with NOTE_CACHE_LOCK:
+            NOTE_CACHE.pop(media.file_unique_id, None)
         db.add_credits(uid, config.CREDITS_PER_VIDEO)
         bot.send_message(message.chat.id, f"❌ Convert error: {e}", reply_markup=menu_kb(uid))
 
 
+# =========================
+# REGISTER ADMIN CALLBACKS
+# ✅ fallback এর আগে, নাহলে /admin fallback এ আটকে যায় (telebot প্রথম match করা handler চালায়)
+# =========================
+register_admin_panel(bot, db, config)
+
+
 # =========================
 # FALLBACK TEXT
 # ✅ IMPORTANT: admin waiting থাকলে fallback ধরবে না (broadcast ঠিক হবে)
 # =========================
-@bot.message_handler(func=lambda m: (m.content_type == "text") and (not is_waiting(m.from_user.id)))
+@bot.message_handler(admin_step=False, content_types=["text"])
 def fallback(message):
     db.upsert_user(message.from_user)
     uid = message.from_user.id
     bot.send_message(message.chat.id, "ভিডিও পাঠান ✅ আমি সেটাকে গোল Video Note করে দিবো।", reply_markup=menu_kb(uid))
 
 
-# =========================
-# REGISTER ADMIN CALLBACKS
-# =========================
-register_admin_panel(bot, db, config)
-
+print(f"Video encoder: {choose_encoder()}")
 print("Bot started...")
 bot.infinity_polling(timeout=60, long_polling_timeout=60)
@@ -14,6 +14,16 @@ DB_PATH = os.getenv("DB_PATH", "file.db")
 FREE_CREDITS = int(os.getenv("FREE_CREDITS", "2"))
 CREDITS_PER_VIDEO = int(os.getenv("CREDITS_PER_VIDEO", "1"))
 
+# ffmpeg: concurrent jobs (default = CPU count) and encoder threads per job
+FFMPEG_JOBS = int(os.getenv("FFMPEG_JOBS", "0")) or max(1, os.cpu_count() or 2)
+FFMPEG_THREADS = int(os.getenv("FFMPEG_THREADS", "2"))  # 0 = ffmpeg auto (all cores)
+USE_HWENC = os.getenv("USE_HWENC", "0") == "1"  # GPU encoder probe (nvenc/vaapi/qsv/videotoolbox)
+# RAM-backed scratch dir for in/out files ("" = always use the normal temp dir)
+SHM_DIR = os.getenv("SHM_DIR", "/dev/shm")
+
+# telebot worker threads (ffmpeg jobs are gated separately by FFMPEG_JOBS)
+BOT_THREADS = int(os.getenv("BOT_THREADS", "8"))
+
 # links / channel
 REQUIRED_CHANNEL = os.getenv("REQUIRED_CHANNEL", "@iuo82828")
 VOICE_SUPPORT_LINK = os.getenv("VOICE_SUPPORT_LINK", "https://t.me/ariyanvoice")
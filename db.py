@@ -1,231 +1,555 @@
+import contextvars
+import queue
 import sqlite3
+import threading
 import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from pathlib import Path
+
+from cachetools import TTLCache
+
+
+# ---------- SQL ----------
+# hoisted so every call hands sqlite3 the same SQL text and hits its per-connection statement cache
+_SQL_UPSERT_USER = """
+    INSERT INTO users(id, username, first_name, joined_at, last_seen) VALUES(?,?,?,?,?)
+    ON CONFLICT(id) DO UPDATE SET
+        username=excluded.username, first_name=excluded.first_name, last_seen=excluded.last_seen
+"""
+_SQL_ENSURE_USER = "INSERT OR IGNORE INTO users(id, username, first_name, joined_at, last_seen) VALUES(?,?,?,?,?)"
+# COUNT(*) পুরো table scan করে; trigger দিয়ে রাখা counter এক row read
+_SQL_COUNT_USERS = "SELECT v FROM meta WHERE k='user_count'"
+# tie-break id ASC: idx_users_joined (joined_at DESC, rowid) এর order এর সাথে মিলে, তাই sort লাগে না
+_SQL_LIST_USERS = """
+    SELECT id, username, joined_at, credits
+    FROM users
+    ORDER BY joined_at DESC, id
+    LIMIT ? OFFSET ?
+"""
+# keyset: আগের page এর শেষ row (joined_at, id) এর পর থেকে, OFFSET এর মতো row skip করতে হয় না
+_SQL_LIST_USERS_AFTER = """
+    SELECT id, username, joined_at, credits
+    FROM users
+    WHERE joined_at <= ? AND (joined_at < ? OR id > ?)
+    ORDER BY joined_at DESC, id
+    LIMIT ?
+"""
+_SQL_USER_IDS_AFTER = """
+    SELECT id FROM users
+    WHERE id > ? AND id NOT IN (SELECT user_id FROM dead_users)
+    ORDER BY id LIMIT ?
+"""
+# iter_user_ids এর মতো একই set (dead বাদ), broadcast header এ যেন আসল সংখ্যা দেখায়
+_SQL_COUNT_RECIPIENTS = "SELECT COUNT(*) FROM users WHERE id NOT IN (SELECT user_id FROM dead_users)"
+_SQL_MARK_DEAD = """
+    INSERT INTO dead_users(user_id, marked_at) VALUES(?,?)
+    ON CONFLICT(user_id) DO UPDATE SET marked_at=excluded.marked_at
+"""
+_SQL_UNMARK_DEAD = "DELETE FROM dead_users WHERE user_id=?"
+
+# wallet এখন users এরই column: প্রতিটা write একটাই UPSERT (user না থাকলে joined_at/last_seen=now দিয়ে তৈরি)
+# get_credit / free_claimed / get_usage সব একই row থেকে: একবার পড়ে cache এ রাখি
+_SQL_GET_WALLET = "SELECT credits, validity_start, validity_expire, free_claimed, videos_made FROM users WHERE id=?"
+_SQL_ADD_CREDITS = """
+    INSERT INTO users(id, first_name, joined_at, last_seen, credits) VALUES(?,'',?,?,?)
+    ON CONFLICT(id) DO UPDATE SET credits = credits + excluded.credits
+"""
+_SQL_REMOVE_CREDITS = "UPDATE users SET credits = MAX(0, credits - ?) WHERE id=?"
+_SQL_DEDUCT_CREDITS = "UPDATE users SET credits = credits - ? WHERE id=? AND credits >= ?"
+_SQL_SET_VALIDITY = """
+    INSERT INTO users(id, first_name, joined_at, last_seen, validity_start, validity_expire) VALUES(?,'',?,?,?,?)
+    ON CONFLICT(id) DO UPDATE SET
+        validity_start=excluded.validity_start, validity_expire=excluded.validity_expire
+"""
+_SQL_REMOVE_VALIDITY = """
+    INSERT INTO users(id, first_name, joined_at, last_seen) VALUES(?,'',?,?)
+    ON CONFLICT(id) DO UPDATE SET validity_start=NULL, validity_expire=NULL
+"""
+_SQL_LIST_PREMIUM = """
+    SELECT id, credits, validity_start AS vfrom, validity_expire AS exp
+    FROM users
+    WHERE validity_expire IS NOT NULL AND validity_expire > ?
+    ORDER BY validity_expire DESC
+    LIMIT ?
+"""
+
+_SQL_MARK_FREE_CLAIMED = """
+    INSERT INTO users(id, first_name, joined_at, last_seen, free_claimed) VALUES(?,'',?,?,1)
+    ON CONFLICT(id) DO UPDATE SET free_claimed=1
+"""
+_SQL_INC_VIDEOS = """
+    INSERT INTO users(id, first_name, joined_at, last_seen, videos_made) VALUES(?,'',?,?,1)
+    ON CONFLICT(id) DO UPDATE SET videos_made = videos_made + 1
+"""
+
+# পুরনো DB: আলাদা wallet table থেকে users এ আনা (একবারই চলে)
+_WALLET_COLUMNS = (
+    ("credits", "INTEGER NOT NULL DEFAULT 0"),
+    ("validity_start", "INTEGER"),
+    ("validity_expire", "INTEGER"),
+    ("free_claimed", "INTEGER NOT NULL DEFAULT 0"),
+    ("videos_made", "INTEGER NOT NULL DEFAULT 0"),
+)
+_SQL_MIGRATE_WALLET_USERS = """
+    INSERT OR IGNORE INTO users(id, first_name, joined_at, last_seen)
+    SELECT user_id, '', ?, ? FROM wallet
+"""
+_SQL_MIGRATE_WALLET = """
+    UPDATE users SET (credits, validity_start, validity_expire, free_claimed, videos_made) = (
+        SELECT IFNULL(w.credits,0), w.validity_start, w.validity_expire,
+               IFNULL(w.free_claimed,0), IFNULL(w.videos_made,0)
+        FROM wallet w WHERE w.user_id=users.id
+    )
+    WHERE id IN (SELECT user_id FROM wallet)
+"""
+
+
+def _configure_conn(con):
+    # per-connection settings; journal_mode=WAL is persistent and set once in DB._init
+    con.execute("PRAGMA synchronous=NORMAL")
+    con.execute("PRAGMA temp_store=MEMORY")
+    con.execute("PRAGMA cache_size=-64000")
+    con.execute("PRAGMA mmap_size=268435456")  # 256MB: page read গুলো syscall ছাড়াই memory থেকে
+    con.execute("PRAGMA busy_timeout=5000")
+    con.execute("PRAGMA foreign_keys=ON")
+    # rows index by name or position; list queries return them as-is instead of building dicts
+    con.row_factory = sqlite3.Row
+    return con
+
+
+# ---------- write ops (run on the writer thread, inside its batch transaction) ----------
+def _op_optimize(con):
+    con.execute("PRAGMA optimize")
+
+
+def _op_mark_dead(con, now: int, user_ids):
+    con.executemany(_SQL_MARK_DEAD, [(uid, now) for uid in user_ids])
+
+
+def _op_exec(con, sql: str, params) -> int:
+    return con.execute(sql, params).rowcount
+
+
+def _op_ensure_user(con, now: int, user_id: int, username: str = None):
+    con.execute(_SQL_ENSURE_USER, (user_id, username, "", now, now))
+
+
+def _op_add_credits_bulk(con, now: int, pairs):
+    con.executemany(_SQL_ADD_CREDITS, [(uid, now, now, amount) for uid, amount in pairs])
 
 
 class DB:
-    def __init__(self, path: str):
+    def __init__(self, path: str, readers: int = 4):
         self.path = path
+        # user_id -> (credits, validity_start, validity_expire, free_claimed, videos_made)
+        # প্রতিটা write এ invalidate হয়, তাই TTL শুধু safety net
+        self._wallet_cache = TTLCache(maxsize=4096, ttl=60)
+        # প্রতিটা invalidate এ বাড়ে; read চলাকালীন write হলে পুরনো row আর cache এ বসে না
+        self._wallet_gen = 0
+        self._cache_lock = threading.Lock()
+        # user_id -> (username, first_name) যেটা শেষবার লেখা হয়েছে; 30s এর মধ্যে same হলে আর লিখি না
+        self._recent_users = TTLCache(maxsize=4096, ttl=30)
+
+        # 1 writer (serialized by _wlock) + N read-only connections; WAL lets reads run during a write
+        self._wlock = threading.RLock()
+        self._wcon = self._connect()
         self._init()
+        self._optimized_at = time.monotonic()
+
+        self._readers = queue.Queue()
+        for _ in range(readers):
+            self._readers.put(self._connect(read_only=True))
+
+        # group commit: সব write queue তে যায়, writer thread যা জমেছে সব এক transaction এ commit করে
+        self._writes = queue.Queue()
+        # transaction() চলাকালীন: এই context এর read/write সরাসরি writer connection এ যায়
+        # value = commit এর পরে যাদের cache ফেলতে হবে (None = transaction নেই)
+        self._tx = contextvars.ContextVar(f"db_tx_{id(self)}", default=None)
+        # BEGIN এর সময়ের timestamp: একই transaction এর সব row এ একই now
+        self._tx_now = contextvars.ContextVar(f"db_tx_now_{id(self)}", default=None)
+        threading.Thread(target=self._writer_loop, name="db-writer", daemon=True).start()
+        threading.Thread(target=self._checkpoint_loop, name="db-checkpoint", daemon=True).start()
+
+    def _connect(self, read_only: bool = False):
+        # autocommit: single statements commit on their own, multi-statement writes use _write_tx
+        if read_only:
+            uri = Path(self.path).resolve().as_uri() + "?mode=ro"
+            con = sqlite3.connect(
+                uri, uri=True, check_same_thread=False, isolation_level=None, cached_statements=256
+            )
+        else:
+            con = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, cached_statements=256)
+        return _configure_conn(con)
 
-    def _conn(self):
-        return sqlite3.connect(self.path, check_same_thread=False)
+    @contextmanager
+    def _reader(self):
+        if self._tx.get() is not None:
+            # transaction এর ভেতরে নিজের uncommitted write দেখতে হবে, আর snapshot ও একটাই থাকে
+            yield self._wcon
+            return
+        con = self._readers.get()
+        try:
+            yield con
+        finally:
+            self._readers.put(con)
+
+    @contextmanager
+    def _writer(self):
+        with self._wlock:
+            yield self._wcon
+
+    @contextmanager
+    def _write_tx(self, begin: str = "BEGIN"):
+        with self._writer() as con:
+            con.execute(begin)
+            try:
+                yield con
+                con.execute("COMMIT")
+            except BaseException:
+                # COMMIT fail করলেও connection যেন transaction এ আটকে না থাকে;
+                # SQLite নিজে rollback করে থাকলে আবার ROLLBACK দিলে আসল error ঢাকা পড়ে যায়
+                if con.in_transaction:
+                    con.execute("ROLLBACK")
+                raise
+
+    @contextmanager
+    def transaction(self):
+        # with db.transaction(): ... -> ভেতরের সব write এক BEGIN IMMEDIATE/COMMIT এ (একটাই fsync)
+        # চলাকালীন writer thread অপেক্ষা করে; nested হলে বাইরের transaction এর অংশ হয়ে যায়
+        if self._tx.get() is not None:
+            yield self
+            return
+
+        forget = set()
+        try:
+            with self._write_tx("BEGIN IMMEDIATE"):
+                token = self._tx.set(forget)
+                now_token = self._tx_now.set(int(time.time()))
+                try:
+                    yield self
+                finally:
+                    self._tx_now.reset(now_token)
+                    self._tx.reset(token)
+        finally:
+            # commit/rollback এর পরেই cache ফেলি, নাহলে মাঝখানে পুরনো value আবার cache হতে পারে
+            with self._cache_lock:
+                self._wallet_gen += 1
+                for uid in forget:
+                    self._wallet_cache.pop(uid, None)
+
+    def _now(self) -> int:
+        now = self._tx_now.get()
+        return now if now is not None else int(time.time())
 
     def _init(self):
-        con = self._conn()
-        cur = con.cursor()
-
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS users(
-            id INTEGER PRIMARY KEY,
-            username TEXT,
-            first_name TEXT,
-            joined_at INTEGER,
-            last_seen INTEGER
-        )
-        """)
-
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS wallet(
-            user_id INTEGER PRIMARY KEY,
-            credits INTEGER DEFAULT 0,
-            validity_start INTEGER,
-            validity_expire INTEGER,
-            free_claimed INTEGER DEFAULT 0,
-            videos_made INTEGER DEFAULT 0
-        )
-        """)
-
-        con.commit()
-        con.close()
+        with self._writer() as con:
+            con.execute("PRAGMA journal_mode=WAL")
+            # WAL file checkpoint এর পরে 64MB এর বেশি থাকলে ছোট করে দেয়; ~1000 page এ auto checkpoint
+            con.execute("PRAGMA journal_size_limit=67108864")
+            con.execute("PRAGMA wal_autocheckpoint=1000")
+
+            con.execute("""
+            CREATE TABLE IF NOT EXISTS users(
+                id INTEGER PRIMARY KEY,
+                username TEXT,
+                first_name TEXT,
+                joined_at INTEGER,
+                last_seen INTEGER,
+                credits INTEGER NOT NULL DEFAULT 0,
+                validity_start INTEGER,
+                validity_expire INTEGER,
+                free_claimed INTEGER NOT NULL DEFAULT 0,
+                videos_made INTEGER NOT NULL DEFAULT 0
+            )
+            """)
+
+            # broadcast এ block/deleted user দের বাদ দিতে; আবার message দিলে upsert_user মুছে দেয়
+            con.execute("""
+            CREATE TABLE IF NOT EXISTS dead_users(
+                user_id INTEGER PRIMARY KEY,
+                marked_at INTEGER
+            )
+            """)
+
+        self._migrate_wallet()
+
+        with self._write_tx("BEGIN IMMEDIATE") as con:
+            # user_count: একবার COUNT(*) দিয়ে seed, তারপর insert/delete trigger এ বাড়ে/কমে
+            con.execute("CREATE TABLE IF NOT EXISTS meta(k TEXT PRIMARY KEY, v INTEGER)")
+            con.execute("INSERT OR IGNORE INTO meta(k, v) SELECT 'user_count', COUNT(*) FROM users")
+            con.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_users_count_ins AFTER INSERT ON users
+            BEGIN
+                UPDATE meta SET v = v + 1 WHERE k='user_count';
+            END
+            """)
+            con.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_users_count_del AFTER DELETE ON users
+            BEGIN
+                UPDATE meta SET v = v - 1 WHERE k='user_count';
+            END
+            """)
+
+        with self._writer() as con:
+            # list_users: ORDER BY joined_at DESC / list_premium: validity_expire range (only premium rows)
+            con.execute("CREATE INDEX IF NOT EXISTS idx_users_joined ON users(joined_at DESC)")
+            con.execute(
+                "CREATE INDEX IF NOT EXISTS idx_users_expire ON users(validity_expire) "
+                "WHERE validity_expire IS NOT NULL"
+            )
+            con.execute("PRAGMA optimize")
+
+    def _migrate_wallet(self):
+        # users + wallet আলাদা table ছিল (একই PK); এখন এক table, তাই JOIN আর দুইবার ensure লাগে না
+        with self._write_tx("BEGIN IMMEDIATE") as con:
+            has = {r[1] for r in con.execute("PRAGMA table_info(users)")}
+            for name, decl in _WALLET_COLUMNS:
+                if name not in has:
+                    con.execute(f"ALTER TABLE users ADD COLUMN {name} {decl}")
+
+            if not con.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='wallet'").fetchone():
+                return
+            now = int(time.time())
+            con.execute(_SQL_MIGRATE_WALLET_USERS, (now, now))
+            con.execute(_SQL_MIGRATE_WALLET)
+            con.execute("DROP TRIGGER IF EXISTS trg_users_wallet")
+            con.execute("DROP TABLE wallet")
+
+    def checkpoint(self, mode: str = "FULL"):
+        # FULL: WAL এর সব page main db file এ লিখে দেয় (file টা নিজে পাঠানোর আগে দরকার)
+        # PASSIVE: reader/writer কাউকে আটকায় না, যতটুকু পারে ততটুকু
+        with self._writer() as con:
+            con.execute(f"PRAGMA wal_checkpoint({mode})")
+
+    CHECKPOINT_EVERY = 300
+
+    def _checkpoint_loop(self):
+        # auto checkpoint এর বাইরে ৫ মিনিট পর পর, যাতে reader দের WAL এ বেশি page খুঁজতে না হয়
+        while True:
+            time.sleep(self.CHECKPOINT_EVERY)
+            try:
+                self.checkpoint("PASSIVE")
+            except Exception as e:
+                print(f"checkpoint failed: {e}")
+
+    # ---------- group commit ----------
+    WRITE_BATCH = 256
+
+    def _submit(self, fn, *args) -> Future:
+        fut = Future()
+        self._writes.put((fn, args, fut))
+        return fut
+
+    def _write(self, fn, *args):
+        # commit হওয়া পর্যন্ত wait করে, তারপর fn এর result দেয়
+        if self._tx.get() is not None:
+            return fn(self._wcon, *args)
+        return self._submit(fn, *args).result()
+
+    def _writer_loop(self):
+        while True:
+            batch = [self._writes.get()]
+            while len(batch) < self.WRITE_BATCH:
+                try:
+                    batch.append(self._writes.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                self._run_batch(batch)
+            except Exception as e:
+                print(f"write batch failed ({len(batch)} ops): {e}")
+                for _, _, fut in batch:
+                    if fut is not None and not fut.done():
+                        fut.set_exception(e)
+
+    def _run_batch(self, batch):
+        upserts = [args for fn, args, _ in batch if fn is None]
+        ops = [(fn, args, fut) for fn, args, fut in batch if fn is not None]
+        done = []
+
+        with self._write_tx("BEGIN IMMEDIATE") as con:
+            if upserts:
+                con.executemany(_SQL_UPSERT_USER, upserts)
+                con.executemany(_SQL_UNMARK_DEAD, [(r[0],) for r in upserts])
+
+            # প্রতিটা op নিজের savepoint এ: একটা fail করলে শুধু সেটাই rollback, বাকিরা commit হয়
+            for fn, args, fut in ops:
+                con.execute("SAVEPOINT op")
+                try:
+                    res = fn(con, *args)
+                except Exception as e:
+                    con.execute("ROLLBACK TO op")
+                    con.execute("RELEASE op")
+                    done.append((fut, None, e))
+                else:
+                    con.execute("RELEASE op")
+                    done.append((fut, res, None))
+
+        # result গুলো COMMIT এর পরেই caller কে দিই
+        for fut, res, err in done:
+            if err is not None:
+                fut.set_exception(err)
+            else:
+                fut.set_result(res)
 
     # ---------- users ----------
     def upsert_user(self, u):
-        now = int(time.time())
-        con = self._conn()
-        cur = con.cursor()
-
-        cur.execute(
-            "INSERT OR IGNORE INTO users(id, username, first_name, joined_at, last_seen) VALUES(?,?,?,?,?)",
-            (u.id, u.username, u.first_name, now, now),
-        )
-        cur.execute(
-            "UPDATE users SET username=?, first_name=?, last_seen=? WHERE id=?",
-            (u.username, u.first_name, now, u.id),
-        )
-
-        cur.execute("INSERT OR IGNORE INTO wallet(user_id) VALUES(?)", (u.id,))
-        con.commit()
-        con.close()
+        # fire-and-forget: handler wait করে না, পরের batch এর সাথে executemany তে যায়
+        # last_seen ~30s precision এ যথেষ্ট, তাই একই user এর প্রতিটা update এ DB তে যাই না
+        key = (u.username, u.first_name)
+        with self._cache_lock:
+            if self._recent_users.get(u.id) == key:
+                return
+            self._recent_users[u.id] = key
+        now = self._now()
+        self._writes.put((None, (u.id, u.username, u.first_name, now, now), None))
 
     def ensure_user(self, user_id: int, username: str = None):
-        now = int(time.time())
-        con = self._conn()
-        cur = con.cursor()
+        self._write(_op_ensure_user, self._now(), user_id, username)
+
+    def _upsert_wallet(self, user_id: int, sql: str, *values):
+        # users row না থাকলে UPSERT নিজেই তৈরি করে (joined_at/last_seen=now); আলাদা ensure লাগে না
+        now = self._now()
+        self._write(_op_exec, sql, (user_id, now, now) + values)
 
-        cur.execute(
-            "INSERT OR IGNORE INTO users(id, username, first_name, joined_at, last_seen) VALUES(?,?,?,?,?)",
-            (user_id, username, "", now, now),
-        )
-        cur.execute("INSERT OR IGNORE INTO wallet(user_id) VALUES(?)", (user_id,))
+    OPTIMIZE_EVERY = 3600
 
-        con.commit()
-        con.close()
+    def _maybe_optimize(self):
+        # admin panel থেকে মাঝে মাঝে ডাকা হয়; ঘণ্টায় একবার planner stats refresh (wait করি না)
+        now = time.monotonic()
+        if now - self._optimized_at >= self.OPTIMIZE_EVERY:
+            self._optimized_at = now
+            self._submit(_op_optimize)
 
     def count_users(self) -> int:
-        con = self._conn()
-        cur = con.cursor()
-        cur.execute("SELECT COUNT(*) FROM users")
-        n = int(cur.fetchone()[0] or 0)
-        con.close()
-        return n
-
-    def list_users(self, offset=0, limit=10):
-        con = self._conn()
-        cur = con.cursor()
-        cur.execute("""
-            SELECT u.id, u.username, IFNULL(w.credits,0)
-            FROM users u
-            LEFT JOIN wallet w ON w.user_id=u.id
-            ORDER BY u.joined_at DESC
-            LIMIT ? OFFSET ?
-        """, (int(limit), int(offset)))
-        rows = cur.fetchall()
-        con.close()
-
-        out = []
-        for r in rows:
-            out.append({"id": int(r[0]), "username": r[1], "credits": int(r[2])})
-        return out
+        self._maybe_optimize()
+        with self._reader() as con:
+            row = con.execute(_SQL_COUNT_USERS).fetchone()
+        return row[0] if row else 0
+
+    def list_users(self, offset=0, limit=10, after=None):
+        # after=(joined_at, id) দিলে keyset page, নাহলে offset (Prev/Back এর জন্য)
+        with self._reader() as con:
+            if after is not None:
+                joined, uid = int(after[0]), int(after[1])
+                return con.execute(_SQL_LIST_USERS_AFTER, (joined, joined, uid, int(limit))).fetchall()
+            return con.execute(_SQL_LIST_USERS, (int(limit), int(offset))).fetchall()
+
+    def count_recipients(self) -> int:
+        with self._reader() as con:
+            return con.execute(_SQL_COUNT_RECIPIENTS).fetchone()[0]
 
-    def list_user_ids(self):
-        con = self._conn()
-        cur = con.cursor()
-        cur.execute("SELECT id FROM users")
-        rows = cur.fetchall()
-        con.close()
-        return [int(r[0]) for r in rows]
+    def iter_user_ids(self, batch: int = 500):
+        # id ধরে keyset batch: পুরো table memory তে আনি না, আর প্রতি batch এর পর reader ছেড়ে দিই
+        last = 0
+        while True:
+            with self._reader() as con:
+                rows = con.execute(_SQL_USER_IDS_AFTER, (last, int(batch))).fetchall()
+            if not rows:
+                return
+            yield [r[0] for r in rows]
+            last = rows[-1][0]
+
+    def mark_dead(self, user_ids):
+        ids = list(user_ids)
+        if ids:
+            self._write(_op_mark_dead, self._now(), ids)
+            # আবার message দিলে যেন upsert হয়ে dead_users থেকে মুছে যায়
+            with self._cache_lock:
+                for uid in ids:
+                    self._recent_users.pop(uid, None)
+
+    # ---------- wallet cache ----------
+    def _forget(self, user_id: int):
+        forget = self._tx.get()
+        if forget is not None:
+            forget.add(user_id)
+            return
+        with self._cache_lock:
+            self._wallet_gen += 1
+            self._wallet_cache.pop(user_id, None)
+
+    def _wallet(self, user_id: int):
+        in_tx = self._tx.get() is not None
+        if not in_tx:
+            with self._cache_lock:
+                hit = self._wallet_cache.get(user_id)
+                gen = self._wallet_gen
+            if hit is not None:
+                return hit
+
+        # row না থাকলে default; read এর আগে ensure_user এর write লাগে না
+        with self._reader() as con:
+            row = con.execute(_SQL_GET_WALLET, (user_id,)).fetchone()
+        out = tuple(row) if row else (0, None, None, 0, 0)
+        if in_tx:
+            # uncommitted value cache এ রাখি না
+            return out
+        with self._cache_lock:
+            if self._wallet_gen == gen:
+                self._wallet_cache[user_id] = out
+        return out
 
     # ---------- credits / validity ----------
     def get_credit(self, user_id: int):
-        self.ensure_user(user_id)
-        con = self._conn()
-        cur = con.cursor()
-        cur.execute("SELECT credits, validity_start, validity_expire FROM wallet WHERE user_id=?", (user_id,))
-        row = cur.fetchone()
-        con.close()
-        if not row:
-            return 0, None, None
-        return int(row[0] or 0), row[1], row[2]
+        return self._wallet(user_id)[:3]
 
     def add_credits(self, user_id: int, amount: int):
-        self.ensure_user(user_id)
-        con = self._conn()
-        cur = con.cursor()
-        cur.execute("UPDATE wallet SET credits = credits + ? WHERE user_id=?", (int(amount), user_id))
-        con.commit()
-        con.close()
+        self._upsert_wallet(user_id, _SQL_ADD_CREDITS, int(amount))
+        self._forget(user_id)
+
+    def add_credits_bulk(self, pairs):
+        # [(user_id, amount), ...] -> একটাই op: executemany, সব একসাথে commit বা কোনোটাই না
+        pairs = [(int(uid), int(amount)) for uid, amount in pairs]
+        if not pairs:
+            return
+        self._write(_op_add_credits_bulk, self._now(), pairs)
+        for uid, _ in pairs:
+            self._forget(uid)
 
     def remove_credits(self, user_id: int, amount: int):
-        self.ensure_user(user_id)
-        con = self._conn()
-        cur = con.cursor()
-        cur.execute("SELECT credits FROM wallet WHERE user_id=?", (user_id,))
-        c = int(cur.fetchone()[0] or 0)
-        c2 = max(0, c - int(amount))
-        cur.execute("UPDATE wallet SET credits=? WHERE user_id=?", (c2, user_id))
-        con.commit()
-        con.close()
+        # MAX(0, ...) SQL এর ভেতরেই, balance পড়ে Python এ হিসাব করতে হয় না
+        # row না থাকলে কমানোর কিছু নেই, তাই ensure লাগে না
+        self._write(_op_exec, _SQL_REMOVE_CREDITS, (int(amount), user_id))
+        self._forget(user_id)
 
     def deduct_for_video(self, user_id: int, cost: int) -> bool:
-        self.ensure_user(user_id)
-        con = self._conn()
-        cur = con.cursor()
-        cur.execute("SELECT credits FROM wallet WHERE user_id=?", (user_id,))
-        c = int(cur.fetchone()[0] or 0)
-        if c < cost:
-            con.close()
+        # check + deduct একটাই statement এ, তাই আলাদা lock/transaction লাগে না
+        params = (int(cost), user_id, int(cost))
+        if self._write(_op_exec, _SQL_DEDUCT_CREDITS, params) != 1:
             return False
-        cur.execute("UPDATE wallet SET credits = credits - ? WHERE user_id=?", (int(cost), user_id))
-        con.commit()
-        con.close()
+        self._forget(user_id)
         return True
 
     def set_validity(self, user_id: int, days: int):
-        self.ensure_user(user_id)
-        now = int(time.time())
+        now = self._now()
         exp = now + int(days) * 86400
-        con = self._conn()
-        cur = con.cursor()
-        cur.execute(
-            "UPDATE wallet SET validity_start=?, validity_expire=? WHERE user_id=?",
-            (now, exp, user_id),
-        )
-        con.commit()
-        con.close()
+        self._upsert_wallet(user_id, _SQL_SET_VALIDITY, now, exp)
+        self._forget(user_id)
 
     def remove_validity(self, user_id: int):
-        self.ensure_user(user_id)
-        con = self._conn()
-        cur = con.cursor()
-        cur.execute(
-            "UPDATE wallet SET validity_start=NULL, validity_expire=NULL WHERE user_id=?",
-            (user_id,),
-        )
-        con.commit()
-        con.close()
+        self._upsert_wallet(user_id, _SQL_REMOVE_VALIDITY)
+        self._forget(user_id)
 
     def list_premium(self, limit=50):
-        now = int(time.time())
-        con = self._conn()
-        cur = con.cursor()
-        cur.execute("""
-            SELECT u.id, IFNULL(w.credits,0), w.validity_start, w.validity_expire
-            FROM users u
-            JOIN wallet w ON w.user_id=u.id
-            WHERE w.validity_expire IS NOT NULL AND w.validity_expire > ?
-            ORDER BY w.validity_expire DESC
-            LIMIT ?
-        """, (now, int(limit)))
-        rows = cur.fetchall()
-        con.close()
-
-        out = []
-        for r in rows:
-            out.append({"id": int(r[0]), "credits": int(r[1]), "vfrom": r[2], "exp": r[3]})
-        return out
+        now = self._now()
+        with self._reader() as con:
+            return con.execute(_SQL_LIST_PREMIUM, (now, int(limit))).fetchall()
 
     # ---------- free claim ----------
     def free_claimed(self, user_id: int) -> bool:
-        self.ensure_user(user_id)
-        con = self._conn()
-        cur = con.cursor()
-        cur.execute("SELECT free_claimed FROM wallet WHERE user_id=?", (user_id,))
-        row = cur.fetchone()
-        con.close()
-        return bool(row and int(row[0] or 0) == 1)
+        return self._wallet(user_id)[3] == 1
 
     def mark_free_claimed(self, user_id: int):
-        self.ensure_user(user_id)
-        con = self._conn()
-        cur = con.cursor()
-        cur.execute("UPDATE wallet SET free_claimed=1 WHERE user_id=?", (user_id,))
-        con.commit()
-        con.close()
+        self._upsert_wallet(user_id, _SQL_MARK_FREE_CLAIMED)
+        self._forget(user_id)
 
     # ---------- usage ----------
     def inc_videos(self, user_id: int):
-        self.ensure_user(user_id)
-        con = self._conn()
-        cur = con.cursor()
-        cur.execute("UPDATE wallet SET videos_made = videos_made + 1 WHERE user_id=?", (user_id,))
-        con.commit()
-        con.close()
+        self._upsert_wallet(user_id, _SQL_INC_VIDEOS)
+        self._forget(user_id)
 
     def get_usage(self, user_id: int) -> int:
-        self.ensure_user(user_id)
-        con = self._conn()
-        cur = con.cursor()
-        cur.execute("SELECT videos_made FROM wallet WHERE user_id=?", (user_id,))
-        row = cur.fetchone()
-        con.close()
-        return int(row[0] or 0) if row else 0
+        return self._wallet(user_id)[4]